@@ -16,7 +16,6 @@ let
     pyyaml
     types-pyyaml
     sh
-    numpy
   ];
   formatDeps = deps:
     let
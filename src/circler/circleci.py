@@ -2,22 +2,50 @@ from __future__ import annotations
 
 import json
 import os
+from collections.abc import Callable
 from dataclasses import dataclass, field, fields, is_dataclass
-from functools import singledispatch
-from typing import Any, Literal
+from functools import cache
+from typing import TYPE_CHECKING, Any, Literal
 
-import requests
-import yaml
+if TYPE_CHECKING:
+    import requests
+    import yaml
 
 
-def string_presenter(dumper: yaml.Dumper, data: str) -> Any:
+def string_presenter(dumper: yaml.representer.BaseRepresenter, data: str) -> Any:
     if "\n" in data:
         data = data.lstrip()
         return dumper.represent_scalar("tag:yaml.org,2002:str", data, style="|")
     return dumper.represent_scalar("tag:yaml.org,2002:str", data)
 
 
-yaml.add_representer(str, string_presenter)
+@cache
+def yaml_dumper() -> type[yaml.representer.BaseRepresenter]:
+    import yaml
+
+    try:
+        from yaml import CSafeDumper as Dumper
+    except ImportError:
+        from yaml import SafeDumper as Dumper  # type: ignore[assignment]
+
+    yaml.add_representer(str, string_presenter, Dumper=Dumper)
+    return Dumper
+
+
+@cache
+def circleci_session() -> requests.Session:
+    import requests
+
+    session = requests.Session()
+    session.headers.update({"Accept": "application/json"})
+    return session
+
+
+@cache
+def dataclass_fields(cls: type) -> tuple[str, ...] | None:
+    if not is_dataclass(cls):
+        return None
+    return tuple(f.name for f in fields(cls))
 
 
 def serialize_base(x: Any, skip: list[str] | None = None) -> Any:
@@ -25,25 +53,43 @@ def serialize_base(x: Any, skip: list[str] | None = None) -> Any:
         return [serialize(i) for i in x]
     if isinstance(x, dict):
         return {k: serialize(v) for (k, v) in x.items()}
-    if not is_dataclass(x) or isinstance(x, type):
+    names = dataclass_fields(x.__class__)
+    if names is None:
         return x
-    ret = {}
-    for f in fields(x):
-        if skip is not None and f.name in skip:
-            continue
-        v = getattr(x, f.name)
-        if v is None:
-            continue
-        ret[f.name] = serialize(v)
-    return ret
+    if skip is not None:
+        names = tuple(n for n in names if n not in skip)
+    return {name: serialize(v) for name in names if (v := getattr(x, name)) is not None}
+
+
+SERIALIZERS: dict[type, Callable[[Any], Any]] = {}
+
+
+def serializer[T](cls: type[T]) -> Callable[[Callable[[T], Any]], Callable[[T], Any]]:
+    def inner(fn: Callable[[T], Any]) -> Callable[[T], Any]:
+        SERIALIZERS[cls] = fn
+        find_serializer.cache_clear()
+        return fn
+
+    return inner
+
+
+@cache
+def find_serializer(cls: type) -> Callable[[Any], Any] | None:
+    for c in cls.__mro__:
+        if c in SERIALIZERS:
+            return SERIALIZERS[c]
+    return None
 
 
-@singledispatch
 def serialize(x: Any, skip: list[str] | None = None) -> Any:
-    return serialize_base(x, skip)
+    fn = find_serializer(x.__class__)
+    if fn is None:
+        return serialize_base(x, skip)
+    return fn(x)
 
 
 class DictRef[T]:
+    __slots__ = ("key", "_dict")
     key: str
     _dict: dict[str, T]
 
@@ -57,22 +103,22 @@ class DictRef[T]:
         return self._dict[self.key]
 
 
-@serialize.register(DictRef)
+@serializer(DictRef)
 def _(x: DictRef[Any]) -> str:
     return x.key
 
 
-@dataclass
+@dataclass(slots=True)
 class Docker:
     image: str
 
 
-@serialize.register
+@serializer(Docker)
 def _(x: Docker) -> dict[str, Any]:
     return {"docker": [serialize_base(x)]}
 
 
-@dataclass
+@dataclass(slots=True)
 class Executor:
     kind: Docker
     resource_class: str
@@ -82,7 +128,7 @@ class Executor:
         return Executor(Docker(image), resource_class)
 
 
-@serialize.register
+@serializer(Executor)
 def _(x: Executor) -> dict[str, Any]:
     kind = serialize(x.kind)
     ret = serialize_base(x, skip=["kind"])
@@ -91,7 +137,7 @@ def _(x: Executor) -> dict[str, Any]:
     return ret
 
 
-@dataclass
+@dataclass(slots=True)
 class Run:
     name: str
     command: str
@@ -99,17 +145,17 @@ class Run:
     no_output_timeout: str | None = None
 
 
-@serialize.register
+@serializer(Run)
 def _(x: Run) -> dict[str, Any]:
     return {"run": serialize_base(x)}
 
 
-@dataclass
+@dataclass(slots=True)
 class Checkout:
     pass
 
 
-@serialize.register
+@serializer(Checkout)
 def _(_: Checkout) -> str:
     return "checkout"
 
@@ -117,7 +163,7 @@ def _(_: Checkout) -> str:
 type Step = Run | Checkout
 
 
-@dataclass
+@dataclass(slots=True)
 class StepsJob:
     executor: DictRef[Executor]
     steps: list[Step]
@@ -130,7 +176,7 @@ class NoOpJob:
     pass
 
 
-@serialize.register
+@serializer(NoOpJob)
 def _(_: NoOpJob) -> dict[str, Any]:
     return {"type": "no-op"}
 
@@ -138,14 +184,14 @@ def _(_: NoOpJob) -> dict[str, Any]:
 type Job = StepsJob | NoOpJob
 
 
-@dataclass
+@dataclass(slots=True)
 class JobInstance:
     job: DictRef[Job]
     arguments: dict[str, Any] = field(default_factory=dict)
     requires: list[DictRef[Job]] = field(default_factory=list)
 
 
-@serialize.register
+@serializer(JobInstance)
 def _(x: JobInstance) -> dict[str, Any]:
     data = serialize(x.arguments)
     requires = serialize(x.requires)
@@ -153,23 +199,23 @@ def _(x: JobInstance) -> dict[str, Any]:
     return {x.job.key: data}
 
 
-@dataclass
+@dataclass(slots=True)
 class Equal:
     lhs: str
     rhs: str
 
 
-@serialize.register
+@serializer(Equal)
 def _(x: Equal) -> dict[str, Any]:
     return {"equal": [x.lhs, x.rhs]}
 
 
-@dataclass
+@dataclass(slots=True)
 class Not:
     cond: Cond
 
 
-@serialize.register
+@serializer(Not)
 def _(x: Not) -> dict[str, Any]:
     return {"not": serialize(x.cond)}
 
@@ -177,19 +223,19 @@ def _(x: Not) -> dict[str, Any]:
 type Cond = Equal | Not
 
 
-@dataclass
+@dataclass(slots=True)
 class Workflow:
     jobs: list[JobInstance]
     when: Cond | None = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Parameter:
     type: str
     default: str | None
 
 
-@dataclass
+@dataclass(slots=True)
 class Pipeline:
     version: Literal["2.1"] = "2.1"
     jobs: dict[str, Job] = field(default_factory=dict)
@@ -211,29 +257,26 @@ class Pipeline:
         return DictRef(self.parameters, name, p)
 
     def dump_yaml(self) -> str:
+        import yaml
+
         d = serialize(self)
-        return yaml.dump(d)
+        return yaml.dump(d, Dumper=yaml_dumper())
 
     def dump_json(self) -> str:
         d = serialize(self)
-        return json.dumps(d)
-
-    def dump_json_str(self) -> str:
-        j = self.dump_json()
-        return json.dumps(j)
+        return json.dumps(d, separators=(",", ":"))
 
     def exec(self, args: dict[str, Any] | None) -> None:
         if not args:
             args = {}
         payload = {
             "continuation-key": os.environ["CIRCLECI_CONTINUATION_KEY"],
-            "configuration": self.dump_json_str(),
+            "configuration": self.dump_json(),
             "parameters": args,
         }
-        requests.post(
+        circleci_session().post(
             "https://circleci.com/api/v2/pipeline/continue",
             json=payload,
-            headers={"Accept": "application/json"},
         )
 
 
@@ -2,26 +2,37 @@ from __future__ import annotations
 
 import contextlib
 import json
+import os
+import re
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import cache
 from typing import Any
 
 
-@dataclass
+@dataclass(slots=True)
 class Derivation:
     name: str
     drv: str
     outputs: dict[str, str]
-    deps: list[Derivation]
+    deps: tuple[Derivation, ...]
     meta: dict[str, Any]
 
 
+SAFE_NAME = str.maketrans(".", "_")
+
+
+@cache
 def get_safe_name(name: str) -> str:
-    return name.replace(".", "_")
+    return name.translate(SAFE_NAME)
 
 
-def filter_cached(drvs: dict[str, Derivation]) -> None:
-    paths = [i for d in drvs.values() for i in d.outputs.values()]
+# Paths per nix path-info call, keeps the command line within limits
+CACHE_QUERY_CHUNK = 256
+
+
+def get_cached_paths(paths: list[str]) -> set[str]:
     out = subprocess.run(
         [
             "nix",
@@ -36,12 +47,22 @@ def filter_cached(drvs: dict[str, Derivation]) -> None:
         check=True,
     )
     result: dict[str, Any] = json.loads(out.stdout)
-    for d in list(drvs.values()):
-        for o in d.outputs.values():
-            if result.get(o) is None:
-                break
-        else:
-            del drvs[d.name]
+    return {k for (k, v) in result.items() if v is not None}
+
+
+def get_cached_outputs(paths: list[str]) -> set[str]:
+    chunks = [
+        paths[i : i + CACHE_QUERY_CHUNK]
+        for i in range(0, len(paths), CACHE_QUERY_CHUNK)
+    ]
+    with ThreadPoolExecutor() as ex:
+        return set().union(*ex.map(get_cached_paths, chunks))
+
+
+def filter_cached(drvs: dict[str, Derivation]) -> None:
+    cached = get_cached_outputs([i for d in drvs.values() for i in d.outputs.values()])
+    for name in [k for (k, d) in drvs.items() if cached.issuperset(d.outputs.values())]:
+        del drvs[name]
 
 
 def filter_disabled(drvs: dict[str, Derivation]) -> None:
@@ -53,14 +74,43 @@ def filter_disabled(drvs: dict[str, Derivation]) -> None:
             del drvs[d.name]
 
 
-def get_all_deps(drv: str) -> list[str]:
+DOT_EDGE = re.compile(r'^"([^"]+)" -> "([^"]+)"', re.MULTILINE)
+
+
+def get_all_deps_bulk(drvs: list[str]) -> dict[str, set[str]]:
     result = subprocess.run(
-        ["nix-store", "--query", "--requisites", drv],
+        ["nix-store", "--query", "--graph", *drvs],
         capture_output=True,
         text=True,
         check=True,
     )
-    return result.stdout.strip().split("\n")
+    # Graph nodes are store path basenames, edges go from reference to referrer
+    store_dir = os.path.dirname(drvs[0]) if drvs else ""
+    refs: dict[str, set[str]] = {drv: set() for drv in drvs}
+    for ref, path in DOT_EDGE.findall(result.stdout):
+        ref = os.path.join(store_dir, ref)
+        refs.setdefault(ref, set())
+        refs.setdefault(os.path.join(store_dir, path), set()).add(ref)
+
+    # Restrict each closure to the requested derivations
+    wanted = set(drvs)
+    closures: dict[str, set[str]] = {}
+    for drv in drvs:
+        stack = [drv]
+        while stack:
+            cur = stack[-1]
+            if cur in closures:
+                stack.pop()
+                continue
+            pending = [r for r in refs[cur] if r not in closures]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            closures[cur] = {cur} & wanted
+            for r in refs[cur]:
+                closures[cur] |= closures[r]
+    return {drv: closures[drv] for drv in drvs}
 
 
 def load_derivations(items: list[Any]) -> dict[str, Derivation]:
@@ -69,16 +119,20 @@ def load_derivations(items: list[Any]) -> dict[str, Derivation]:
             name=i["attr"],
             drv=i["drvPath"],
             outputs=i["outputs"],
-            deps=[],
+            deps=(),
             meta=i["meta"],
         )
         for i in items
     }
-    filter_cached(drvs)
+    # The binary cache query is remote, run the local graph query meanwhile
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        all_deps = ex.submit(get_all_deps_bulk, [d.drv for d in drvs.values()])
+        filter_cached(drvs)
     filter_disabled(drvs)
     drvMap = {i.drv: drvs[i.name] for i in drvs.values()}
-    for i in drvs.values():
-        v = drvs[i.name]
-        v.deps = [drvMap[d] for d in get_all_deps(i.drv) if d in drvMap and d != v.drv]
+    closures = all_deps.result()
+    for v in drvMap.values():
+        deps = closures[v.drv] & drvMap.keys()
+        v.deps = tuple(drvMap[d] for d in sorted(deps) if d != v.drv)
 
     return drvs
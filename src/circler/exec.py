@@ -1,3 +1,4 @@
+import contextlib
 import os
 import pickle
 import sys
@@ -5,16 +6,18 @@ from typing import Any
 
 import sh as _sh  # type: ignore
 
-try:
-    with open("/tmp/env.pickle", "rb") as p:
-        env = pickle.load(p)
-except FileNotFoundError:
-    env = os.environ.copy()
+ENV_LOG = "/tmp/env.log"
+
+env: dict[str, Any] = os.environ.copy()
+with contextlib.suppress(FileNotFoundError, EOFError), open(ENV_LOG, "rb") as p:
+    while True:
+        key, val = pickle.load(p)
+        env[key] = val
 
 sh = _sh.bake(_tee=True, _out=sys.stdout, _err=sys.stderr)
 
 
 def export(key: str, val: Any) -> None:
     env[key] = val
-    with open("/tmp/env.pickle", "wb") as p:
-        pickle.dump(env, p)
+    with open(ENV_LOG, "ab") as p:
+        pickle.dump((key, val), p)
@@ -3,27 +3,12 @@ from __future__ import annotations
 import json
 import subprocess
 from dataclasses import dataclass
+from graphlib import TopologicalSorter
 from typing import Any
 
+from .drv import get_all_deps_bulk, get_cached_outputs, get_safe_name
 
-@dataclass
-class Derivation:
-    name: str
-    drv: str
-    outputs: dict[str, str]
-    deps: list[Derivation]
-
-
-def generate_circleci_job(drv: Derivation) -> dict[str, Any]:
-    job = {
-        "docker": [{"image": "nixos/nix:latest"}],
-        "resource_class": "large",
-        "steps": [
-            "checkout",
-            {
-                "run": {
-                    "name": "Configure Nix",
-                    "command": """
+CONFIGURE_NIX = """
 cat \\<< 'EOF' > /etc/nix/nix.conf
   cores = 4
   experimental-features = nix-command flakes ca-derivations
@@ -36,9 +21,34 @@ cat \\<< 'EOF' > /etc/nix/nix.conf
   trusted-users = root circleci
 EOF
 nix run nixpkgs#attic-client -- login lt 'https://nix.leaningtech.com' ${ATTIC_TOKEN}
+"""
+
+DOCKER = [{"image": "nixos/nix:latest"}]
+UPLOAD_STEP = {
+    "run": {
+        "name": "Upload to cache",
+        "command": """
+nix run nixpkgs#attic-client push lt:cheerp result*
 """,
-                }
-            },
+    }
+}
+
+
+@dataclass(slots=True)
+class Derivation:
+    name: str
+    drv: str
+    outputs: dict[str, str]
+    deps: tuple[Derivation, ...]
+
+
+def generate_circleci_job(drv: Derivation) -> dict[str, Any]:
+    job = {
+        "docker": DOCKER,
+        "resource_class": "large",
+        "steps": [
+            "checkout",
+            "configure-nix",
             {
                 "run": {
                     "name": f"Build {drv.name}",
@@ -48,42 +58,35 @@ nix-store --add-root result --realize {drv.drv}
 """,
                 }
             },
-            {
-                "run": {
-                    "name": "Upload to cache",
-                    "command": """
-nix run nixpkgs#attic-client push lt:cheerp result*
-""",
-                }
-            },
+            UPLOAD_STEP,
         ],
     }
     return job
 
 
-def get_safe_name(name: str) -> str:
-    return name.replace(".", "_")
-
-
 def generate_circleci_config(drvs: dict[str, Derivation]) -> dict[str, Any]:
-    jobs = {}
-    workflow_jobs = []
-
     # Generate jobs for each package
-    for drv in drvs.values():
-        safe_name = get_safe_name(drv.name)
-        jobs[safe_name] = generate_circleci_job(drv)
-
-        job_config: dict[str, Any] = {safe_name: {}}
-        if drv.deps:
-            job_config[safe_name]["requires"] = [
-                get_safe_name(dep.name) for dep in drv.deps
-            ]
-
-        workflow_jobs.append(job_config)
+    jobs = {
+        get_safe_name(drv.name): generate_circleci_job(drv) for drv in drvs.values()
+    }
+    workflow_jobs = [
+        {
+            get_safe_name(drv.name): (
+                {"requires": [get_safe_name(dep.name) for dep in drv.deps]}
+                if drv.deps
+                else {}
+            )
+        }
+        for drv in drvs.values()
+    ]
 
     config = {
         "version": 2.1,
+        "commands": {
+            "configure-nix": {
+                "steps": [{"run": {"name": "Configure Nix", "command": CONFIGURE_NIX}}]
+            }
+        },
         "jobs": jobs,
         "workflows": {"build-all": {"jobs": workflow_jobs}},
     }
@@ -92,31 +95,13 @@ def generate_circleci_config(drvs: dict[str, Derivation]) -> dict[str, Any]:
 
 
 def filter_cached(drvs: dict[str, Derivation]) -> None:
-    paths = [i for d in drvs.values() for i in d.outputs.values()]
-    out = subprocess.run(
-        [
-            "nix",
-            "path-info",
-            "--json",
-            "--refresh",
-            "--store",
-            "https://nix.leaningtech.com/cheerp",
-        ]
-        + paths,
-        stdout=subprocess.PIPE,
-        check=True,
-    )
-    result: dict[str, Any] = json.loads(out.stdout)
-    for d in list(drvs.values()):
-        for o in d.outputs.values():
-            if result.get(o) is None:
-                break
-        else:
-            del drvs[d.name]
+    cached = get_cached_outputs([i for d in drvs.values() for i in d.outputs.values()])
+    for name in [k for (k, d) in drvs.items() if cached.issuperset(d.outputs.values())]:
+        del drvs[name]
 
 
 def get_derivations() -> list[dict[str, Any]]:
-    result = subprocess.run(
+    with subprocess.Popen(
         [
             "nix-eval-jobs",
             "-E",
@@ -134,57 +119,46 @@ def get_derivations() -> list[dict[str, Any]]:
         ],
         stdout=subprocess.PIPE,
         text=True,
-        check=True,
-    )
-    items = []
-    for line in result.stdout.strip().split("\n"):
-        i = json.loads(line)
-        items.append(i)
+    ) as proc:
+        assert proc.stdout is not None
+        items = [json.loads(line) for line in proc.stdout if line.strip()]
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
     return items
 
 
-def get_all_deps(drv: str) -> list[str]:
-    result = subprocess.run(
-        ["nix-store", "--query", "--requisites", drv],
-        capture_output=True,
-        text=True,
-        check=True,
-    )
-    return result.stdout.strip().split("\n")
-
-
 def load_derivations() -> dict[str, Derivation]:
     items = get_derivations()
 
     drvs = {
         i["attr"]: Derivation(
-            name=i["attr"], drv=i["drvPath"], outputs=i["outputs"], deps=[]
+            name=i["attr"], drv=i["drvPath"], outputs=i["outputs"], deps=()
         )
         for i in items
     }
     filter_cached(drvs)
     drvMap = {i.drv: drvs[i.name] for i in drvs.values()}
-    for i in drvs.values():
-        v = drvs[i.name]
-        v.deps = [drvMap[d] for d in get_all_deps(i.drv) if d in drvMap and d != v.drv]
+    all_deps = get_all_deps_bulk(list(drvMap))
+    for v in drvs.values():
+        v.deps = tuple(drvMap[d] for d in sorted(all_deps[v.drv]) if d != v.drv)
 
     return drvs
 
 
 def prune_graph(g: dict[str, Derivation]) -> dict[str, Derivation]:
     pruned = {
-        k: Derivation(name=v.name, drv=v.drv, outputs=v.outputs, deps=[])
+        k: Derivation(name=v.name, drv=v.drv, outputs=v.outputs, deps=())
         for (k, v) in g.items()
     }
-    for cur in g:
-        for dx in g[cur].deps:
-            dx_needed = True
-            for dy in g[cur].deps:
-                if dx in dy.deps:
-                    dx_needed = False
-                    break
-            if dx_needed:
-                pruned[cur].deps.append(dx)
+    # Visit dependencies first, so reach is complete for every dependency
+    reach: dict[str, set[str]] = {}
+    graph = {v.name: [d.name for d in v.deps] for v in g.values()}
+    for name in TopologicalSorter(graph).static_order():
+        reach[name] = set(graph[name]).union(*(reach[d] for d in graph[name]))
+
+    for cur, v in g.items():
+        indirect = set().union(*(reach[d.name] for d in v.deps))
+        pruned[cur].deps = tuple(d for d in v.deps if d.name not in indirect)
     return pruned
 
 
@@ -194,5 +168,6 @@ def main() -> None:
     config = generate_circleci_config(drvs)
     print(json.dumps(config, indent=2))
 
+
 if __name__ == "__main__":
     main()
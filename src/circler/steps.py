@@ -1,8 +1,11 @@
 import contextlib
+import copy
 import json
 import os
 from collections.abc import Callable
 from dataclasses import dataclass
+from functools import cache
+from graphlib import TopologicalSorter
 from typing import Any, Self
 
 from .circleci import (
@@ -15,6 +18,7 @@ from .circleci import (
     Step,
     StepsJob,
     Workflow,
+    circleci_session,
 )
 from .drv import Derivation, get_safe_name, load_derivations
 from .exec import env, export, sh
@@ -29,19 +33,22 @@ class CallableRunStep(Run):
         fn: Callable[..., None],
         args: list[Any] | None = None,
     ):
-        args = args or []
-        arg_str = ",".join(repr(a) for a in args)
-        cmd = f"""
-from {fn.__module__} import {fn.__name__}
-{fn.__name__}({arg_str})
-"""
         self.fn = fn
         self.args = args or []
+        self.template = f"""
+from {fn.__module__} import {fn.__name__}
+{fn.__name__}({{}})
+"""
         self.shell = shell or "/tmp/python/bin/python"
-        super().__init__(name, cmd, self.shell)
+        super().__init__(name, self.format_command(self.args), self.shell)
+
+    def format_command(self, args: list[Any]) -> str:
+        return self.template.format(",".join(map(repr, args)))
 
     def bind(self, *args: Any) -> Self:
-        ret = type(self)(self.name, self.shell, self.fn, list(args))
+        ret = copy.copy(self)
+        ret.args = list(args)
+        ret.command = self.format_command(ret.args)
         return ret
 
     def __call__(self, *args: Any, **kwargs: Any) -> None:
@@ -94,7 +101,7 @@ git clone $CIRCLE_REPOSITORY_URL --revision=$CIRCLE_SHA1 --depth 1 .
 )
 
 
-@dataclass
+@dataclass(slots=True)
 class GitRev:
     repo: str
     branch: str
@@ -183,8 +190,10 @@ env | grep CIRCLER
 nix build github:yuri91/circler/{GIT_REV}#python --out-link /tmp/python
 """,
 )
+lt_attic_setup = attic_setup("https://nix.leaningtech.com", "lt", "cheerp")
 
 
+@cache
 def shell_setup(shell_path: str) -> Step:
     return Run(
         name="Setup shell",
@@ -218,7 +227,7 @@ def bootstrap_steps() -> list[Step]:
     return [
         checkout,
         nix_setup,
-        attic_setup("https://nix.leaningtech.com", "lt", "cheerp"),
+        lt_attic_setup,
         shell_bootstrap,
         cache_shell,
     ]
@@ -227,7 +236,7 @@ def bootstrap_steps() -> list[Step]:
 def setup_steps(shell_path: str) -> list[Step]:
     return [
         nix_setup,
-        attic_setup("https://nix.leaningtech.com", "lt", "cheerp"),
+        lt_attic_setup,
         shell_setup(shell_path),
     ]
 
@@ -243,17 +252,14 @@ def generate_main_pipeline() -> None:
 
 @step(name="Trigger continuation")
 def continuation() -> None:
-    import requests
-
     pipeline = env["NEXT_PIPELINE"]
     payload = {
         "continuation-key": os.environ["CIRCLE_CONTINUATION_KEY"],
         "configuration": pipeline,
     }
-    response = requests.post(
+    response = circleci_session().post(
         "https://circleci.com/api/v2/pipeline/continue",
         json=payload,
-        headers={"Accept": "application/json"},
     )
     print(response.text)
     pass
@@ -288,40 +294,19 @@ def generate_build_job(
 
 
 def prune_deps(jobs: dict[str, JobInstance]) -> dict[str, JobInstance]:
-    import numpy as np
-    import numpy.typing as npt
-
-    def transitive_reduction(
-        adj_matrix: npt.NDArray[np.bool_],
-    ) -> npt.NDArray[np.bool_]:
-        n = len(adj_matrix)
-        reach_indirect = np.zeros((n, n), dtype=bool)
-        temp = adj_matrix.copy()
-        for _ in range(n - 1):
-            temp = temp @ adj_matrix
-            reach_indirect |= temp
-        reduction: npt.NDArray[np.bool_] = adj_matrix & ~reach_indirect
-        return reduction
-
     nodes = list(jobs.keys())
     nodes_idx_map = {n: i for i, n in enumerate(nodes)}
-    size = len(nodes)
-    adj = np.zeros((size, size), dtype=bool)
-    for i in range(size):
-        for v in jobs[nodes[i]].requires:
-            j = nodes_idx_map[v.key]
-            adj[i][j] = True
-    adj = transitive_reduction(adj)
+    succ = [sorted({nodes_idx_map[v.key] for v in jobs[n].requires}) for n in nodes]
+    # Visit required jobs first, so reach[j] is complete for every successor j
+    reach: list[set[int]] = [set() for _ in nodes]
+    for i in TopologicalSorter(dict(enumerate(succ))).static_order():
+        reach[i] = set(succ[i]).union(*(reach[j] for j in succ[i]))
+    refs = [jobs[n].job for n in nodes]
     ret = {}
-    for i in range(size):
-        job: JobInstance = jobs[nodes[i]]
-        requires = []
-        for j in range(size):
-            if not adj[i][j]:
-                continue
-            requires.append(jobs[nodes[j]].job)
-        ret_v = JobInstance(job.job, job.arguments, requires)
-        ret[nodes[i]] = ret_v
+    for i, n in enumerate(nodes):
+        indirect = set().union(*(reach[j] for j in succ[i]))
+        requires = [refs[j] for j in succ[i] if j not in indirect]
+        ret[n] = JobInstance(refs[i], jobs[n].arguments, requires)
     return ret
 
 
@@ -336,12 +321,16 @@ def generate_build_pipeline(drvs: dict[str, Derivation]) -> Pipeline:
         jobs[get_safe_name(drv.name)] = generate_build_job(p, docker, drv)
 
     for drv in drvs.values():
-        name = get_safe_name(drv.name)
-        for dep in drv.deps:
-            jobs[name].requires.append(jobs[get_safe_name(dep.name)].job)
+        jobs[get_safe_name(drv.name)].requires.extend(
+            jobs[get_safe_name(dep.name)].job for dep in drv.deps
+        )
 
+    has_consumers = {
+        get_safe_name(dep.name) for drv in drvs.values() for dep in drv.deps
+    }
     jobs["built-all"] = JobInstance(
-        job=p.job("built-all", NoOpJob()), requires=[j.job for j in jobs.values()]
+        job=p.job("built-all", NoOpJob()),
+        requires=[j.job for n, j in jobs.items() if n not in has_consumers],
     )
     jobs = prune_deps(jobs)
     if "BRANCH_TO_MERGE" in env: